@@ -3,7 +3,6 @@ from cirq import *
 from sympy import true
 from typing import Dict, Tuple, List
 from collections import Counter
-from itertools import zip_longest
 from scipy.stats import ks_2samp
 import matplotlib.pyplot as plt
 import sys, pathlib
@@ -32,34 +31,27 @@ def ks_test(counts1 : Counter[int, int], counts2 : Counter[int, int], total_shot
 	'''
 	Carries out K-S test on two frequency lists
 	'''
-	sample1, sample2 = [], []
+	freqs1, freqs2 = np.fromiter(counts1.values(), dtype=np.int64), np.fromiter(counts2.values(), dtype=np.int64)
 
-	for p1, p2 in zip_longest(counts1.items(), counts2.items(), fillvalue=None):
+	# Validate sample sizes before building the samples, so this also holds when run with -O
+	total1, total2 = int(freqs1.sum()), int(freqs2.sum())
+	if total1 != total_shots or total2 != total_shots:
+		raise ValueError(f"Sample size does not match number of shots: got {total1} and {total2}, expected {total_shots}")
 
-		if(p1):
-			sample1 += p1[1] * [p1[0]]
-		
-		if(p2):
-			sample2 += p2[1] * [p2[0]]
+	sample1 = np.repeat(np.fromiter(counts1.keys(), dtype=np.int64), freqs1)
+	sample2 = np.repeat(np.fromiter(counts2.keys(), dtype=np.int64), freqs2)
 
-	assert (len(sample1) == total_shots) and (len(sample2) == total_shots), "Sample size does not match number of shots"
-
-	ks_stat, p_value = ks_2samp(sorted(sample1), sorted(sample2))
+	ks_stat, p_value = ks_2samp(sample1, sample2)
 
 	return p_value
 
 def read_circ_args() -> Tuple[bool, bool]:
-	args : List[str] = sys.argv
-	verbose : bool = False
-	plot : bool = False
-
-	if(len(args) == 3):
-		verbose, plot = args[1] == "-v", args[2] == "-p"
-
-	elif(len(args) == 2):
-		verbose, plot = args[1] == "-v", args[1] == "-p"
+	args : List[str] = sys.argv[1:]
+	verbose : bool = "-v" in args
+	plot : bool = "-p" in args
 
-	elif(len(args) != 1):
+	# Empty args are passed by run.py for flags that are not set. -e only affects qiskit circuits, so is accepted and ignored here
+	if any(arg not in ("", "-v", "-p", "-e") for arg in args):
 		print("Usage: <FILE>.py [-v] [-p]")
 
 	return verbose, plot
@@ -27,11 +27,13 @@ def test_circuit_on_passes(main_circ : Circuit, test_pass : str) -> None:
 		# circuit after pass
 		pass_statevector = main_circ.get_statevector()
 		
-		if np.round(abs(np.vdot(no_pass_statevector, pass_statevector)), 6)==1:
+		fidelity = np.round(np.abs(np.vdot(no_pass_statevector.ravel(), pass_statevector.ravel())), 6)
+
+		if fidelity==1:
 			print("Statevectors are the same\n")
 		else:
 			print ("Statevectors not the same")
-			if (verbose): print("Dot product: ", np.round(abs(np.vdot(no_pass_statevector, pass_statevector)), 6))
+			if (verbose): print("Dot product: ", fidelity)
 
 	except Exception:
 		print("Exception :", traceback.format_exc())
@@ -40,17 +42,12 @@ def read_circ_args() -> Tuple[bool, bool]:
 	"""
 		Read args passed before running the circuit
 	"""
-	args : List[str] = sys.argv
-	verbose : bool = False
-	plot : bool = False
-
-	if(len(args) == 3):
-		verbose, plot = args[1] == "-v", args[2] == "-p"
-
-	elif(len(args) == 2):
-		verbose, plot = args[1] == "-v", args[1] == "-p"
+	args : List[str] = sys.argv[1:]
+	verbose : bool = "-v" in args
+	plot : bool = "-p" in args
 
-	elif(len(args) != 1):
+	# Empty args are passed by run.py for flags that are not set. -e only affects qiskit circuits, so is accepted and ignored here
+	if any(arg not in ("", "-v", "-p", "-e") for arg in args):
 		print("Usage: <FILE>.py [-v] [-p]")
 
 	return verbose, plot
@@ -3,17 +3,28 @@ from qiskit.circuit.library import XGate
 from qiskit.transpiler.passes import *
 from qiskit.transpiler import PassManager, generate_preset_pass_manager
 from qiskit.quantum_info import Statevector
-from numpy import vdot
 from typing import Dict, Tuple, List
 from collections import Counter
-from itertools import zip_longest
 from scipy.stats import ks_2samp
 from qiskit.visualization import plot_histogram
+import matplotlib.pyplot as plt
 import sys, random, pathlib, numpy as np
 
 quantum_circuits_path = pathlib.Path("quantum_circuits")
 plots_path = quantum_circuits_path / "plots"
 
+# K-S p-value below which a routing result is treated as a bug candidate when stopping early
+EARLY_EXIT_P_VALUE = 0.01
+
+# Translation table removing the spaces qiskit puts between classical registers in count keys
+_STRIP_WS = str.maketrans('', '', ' ')
+
+# Aer simulator, created on first use
+_AER = None
+
+# Unrestricted fake backends used for routing, keyed by number of qubits
+_GENERIC_BACKENDS = {}
+
 # List of all optimisation compiler passes
 opt_passes = {  "Optimize1qGates": Optimize1qGates(), "Optimize1qGatesDecomposition":Optimize1qGatesDecomposition(),
                 "Collect1qRuns": Collect1qRuns(), "Collect2qBlocks": Collect2qBlocks(),
@@ -31,6 +42,9 @@ opt_passes = {  "Optimize1qGates": Optimize1qGates(), "Optimize1qGatesDecomposit
                 "NormalizeRXAngle":NormalizeRXAngle(),"OptimizeAnnotated":OptimizeAnnotated()
             }
 
+# Pass managers wrapping each pass above, built once and reused across circuits
+opt_pms = {name: PassManager(p) for name, p in opt_passes.items()}
+
 def generate_custom_mapping(num_qubits : int) -> List[List]:
     '''
         Generate a custom qubut connectivity graph based on total number of qubits. Used to test routing
@@ -38,21 +52,19 @@ def generate_custom_mapping(num_qubits : int) -> List[List]:
     # This is an array holding the generated map
     map = []
 
-    # First ensure all qubits are at least connected to 1 other qubit
+    # First ensure all qubits are at least connected to 1 other qubit, adding them in a random order
     free_qubits = list(range(1, num_qubits))
+    random.shuffle(free_qubits)
     paired_qubits = [0]
-    while(len(free_qubits)):   #While there are still qubits to be added, continue
-        q0 = free_qubits.pop(random.randrange(0, len(free_qubits)))
-        q1 = paired_qubits[random.randrange(0, len(paired_qubits))]
-        paired_qubits.append(q0)    # Re-insert the popped qubit into list of paired qubits
+    for q0 in free_qubits:
+        q1 = random.choice(paired_qubits)
+        paired_qubits.append(q0)
         map.append([q0, q1])
 
-    # The generate a random amount of extra connections between qubits (can repeat)
-    for _ in range(random.randint(0, 10)):
-        q0 = paired_qubits[random.randrange(0, len(paired_qubits))]
-        while (q1 == q0):
-            q1 = paired_qubits[random.randrange(0, len(paired_qubits))]
-        map.append([q0, q1])
+    # The generate a random amount of extra connections between distinct qubits (can repeat)
+    if num_qubits > 1:
+        for _ in range(random.randint(0, 10)):
+            map.append(random.sample(paired_qubits, 2))
     
     return map
 
@@ -63,21 +75,22 @@ def read_circ_args() -> Tuple[bool, bool]:
 		Read arguments passed to circuit before it is run
     """
 
-	args : List[str] = sys.argv
-	verbose : bool = False
-	plot : bool = False
+	args : List[str] = sys.argv[1:]
+	verbose : bool = "-v" in args
+	plot : bool = "-p" in args
 
-	if(len(args) == 3):
-		verbose, plot = args[1] == "-v", args[2] == "-p"
-
-	elif(len(args) == 2):
-		verbose, plot = args[1] == "-v", args[1] == "-p"
-
-	elif(len(args) != 1):
-		print("Usage: <FILE>.py [-v] [-p]")
+	# Empty args are passed by run.py for flags that are not set
+	if any(arg not in ("", "-v", "-p", "-e") for arg in args):
+		print("Usage: <FILE>.py [-v] [-p] [-e]")
 
 	return verbose, plot
 
+def read_early_exit() -> bool:
+	"""
+		Whether testing should stop at the first optimisation level that looks like a bug
+	"""
+	return "-e" in sys.argv[1:]
+
 def simulate_circuit(qc : QuantumCircuit):
     """
     	Evolve statevector in intial 0 state based on quantum circuit
@@ -88,38 +101,102 @@ def simulate_circuit(qc : QuantumCircuit):
 
     return state
 
+def _get_aer():
+    """
+        Lazily create the Aer simulator shared by all simulator runs
+    """
+    global _AER
+
+    if _AER is None:
+        from qiskit_aer import AerSimulator
+        _AER = AerSimulator()
+
+    return _AER
+
+def _runs_natively(qc : QuantumCircuit, s) -> bool:
+    """
+        Check whether a backend without coupling constraints supports every instruction in the circuit, including inside control flow blocks, so it can be run without transpiling
+    """
+    if s.coupling_map is not None:
+        return False
+
+    supported = s.target.operation_names
+    to_check = [qc]
+
+    while to_check:
+        for instruction in to_check.pop().data:
+            operation = instruction.operation
+
+            # Directives such as the barrier added by measure_active do nothing on a simulator
+            if operation.name not in supported and not getattr(operation, "_directive", False):
+                return False
+            to_check.extend(getattr(operation, "blocks", ()))
+
+    return True
+
+def _get_generic_backend(num_qubits : int, coupling_map : List[List] = None):
+    """
+        Return a noiseless GenericBackendV2 for the given number of qubits and coupling map. 
+        Unrestricted backends are reused per qubit count, restricted ones use a fresh random map each time so are built per call
+    """
+    # Lazy importing of Backend
+    from qiskit.providers.fake_provider import GenericBackendV2
+
+    if coupling_map is not None:
+        return GenericBackendV2(num_qubits=num_qubits, seed=1234, coupling_map=coupling_map, noise_info=False)
+
+    if num_qubits not in _GENERIC_BACKENDS:
+        _GENERIC_BACKENDS[num_qubits] = GenericBackendV2(num_qubits=num_qubits, seed=1234, noise_info=False)
+
+    return _GENERIC_BACKENDS[num_qubits]
+
 def preprocess_counts(counts :  Counter[Tuple[str, ...], int]) -> Counter[int, int]:
 	'''
-		Given a dict mapping binary values to number of times they appear, return a sorted dict with each binary tuple converted into a base 10 int
+		Given a dict mapping binary values to number of times they appear, return a dict with each binary string converted into a base 10 int
 	'''
-	out : Counter[Tuple[int, ...], int] = {}
+	if not counts:
+		return {}
 
-	for k in counts.keys():
-		out[int(k.replace(' ', ''), 2)] = counts[k]
-          
-	return dict(sorted(out.items()))
+	# All keys share the same layout, so decode them together as rows of a uint8 matrix, dropping register separator columns
+	keys = np.array(list(counts.keys()), dtype='S')
+	bits = keys.view(np.uint8).reshape(len(keys), -1)
+	bits = bits[:, bits[0] != ord(' ')] - ord('0')
+	n_bits = bits.shape[1]
+
+	# Values this wide do not fit in an int64, and anything other than 0/1 digits (including empty keys, whose padding
+	# wraps around in uint8) is not a bitstring. Convert these one at a time, which also raises on malformed keys
+	if n_bits == 0 or n_bits > 63 or (bits > 1).any():
+		return {int(k.translate(_STRIP_WS), 2): v for k, v in counts.items()}
+
+	weights = np.left_shift(1, np.arange(n_bits - 1, -1, -1, dtype=np.int64))
+
+	return dict(zip((bits @ weights).tolist(), counts.values()))
 
 
 def ks_test(counts1 : Counter[int, int], counts2 : Counter[int, int], total_shots : int) -> float:
 	'''
 	Carries out K-S test on two frequency lists
 	'''
-	sample1, sample2 = [], []
+	# Results wider than 63 bits do not fit in an int64. The K-S statistic only depends on the ordering of values,
+	# so replace every key with its rank among the keys of both samples
+	all_keys = counts1.keys() | counts2.keys()
+	if max(all_keys, default=0) > np.iinfo(np.int64).max:
+		ranks = {k: i for i, k in enumerate(sorted(all_keys))}
+		counts1 = {ranks[k]: v for k, v in counts1.items()}
+		counts2 = {ranks[k]: v for k, v in counts2.items()}
 
-	for p1, p2 in zip_longest(counts1.items(), counts2.items(), fillvalue=None):
-		num1, num2 = 0, 0
+	keys1, freqs1 = np.fromiter(counts1.keys(), dtype=np.int64), np.fromiter(counts1.values(), dtype=np.int64)
+	keys2, freqs2 = np.fromiter(counts2.keys(), dtype=np.int64), np.fromiter(counts2.values(), dtype=np.int64)
 
-		if(p1):
-			#for i in range(len(p1[0])): num1 += (p1[0][i] * (2**(len(p1[0]) - i)))
-			sample1 += p1[1] * [p1[0]]
-		
-		if(p2):
-			#for i in range(len(p2[0])): num2 += (p2[0][i] * (2**(len(p2[0]) - i)))
-			sample2 += p2[1] * [p2[0]]
+	# Validate sample sizes before building the samples, so this also holds when run with -O
+	total1, total2 = int(freqs1.sum()), int(freqs2.sum())
+	if total1 != total_shots or total2 != total_shots:
+		raise ValueError(f"Sample size does not match number of shots: got {total1} and {total2}, expected {total_shots}")
 
-	assert (len(sample1) == total_shots) and (len(sample2) == total_shots), "Sample size does not match number of shots"
+	sample1 = np.repeat(keys1, freqs1)
+	sample2 = np.repeat(keys2, freqs2)
 
-	ks_stat, p_value = ks_2samp(sorted(sample1), sorted(sample2))
+	ks_stat, p_value = ks_2samp(sample1, sample2)
 
 	return p_value 
 
@@ -128,11 +205,13 @@ def compare_statevectors(qc : QuantumCircuit, pass_to_do : str):
 		Run a specific pass on a circuit and compare statevectors before and after the pass is applied
 	"""
 
+    # Reference statevector, evolved from the untouched circuit so it stays independent of the transpiler
+    sv0 = simulate_circuit(qc).data
+
     # AllOpt stands for default transpiler passes
     if pass_to_do == "AllOpt":
         # Need to set the seed for consistent transpiler pass results across optimisation levels
         options = {'layout_method': 'trivial', 'seed_transpiler': 1235, 'routing_method': 'stochastic', 'translation_method': 'translator'}
-        sv0 = simulate_circuit(qc)
 
         print("Applying optimisation levels on circuit, comparing statevectors")
 
@@ -140,29 +219,29 @@ def compare_statevectors(qc : QuantumCircuit, pass_to_do : str):
         for i in range(4):
             pass_manager = generate_preset_pass_manager(optimization_level=i, **options)
             transpiled_circuit = pass_manager.run(qc)
-            sv = simulate_circuit(transpiled_circuit)
+            sv = simulate_circuit(transpiled_circuit).data
+            fidelity = np.abs(np.vdot(sv0.ravel(), sv.ravel()))
 
-            if(np.isclose(1.0 , abs(vdot(sv0, sv)), rtol=0, atol=1e-8)):
+            if(np.isclose(1.0 , fidelity, rtol=0, atol=1e-8)):
                 print("Level ", i, " passed")
             else:
-                print("Failed level ", i, ". Dot product is: " , abs(vdot(sv0, sv)), "\n")
+                print("Failed level ", i, ". Dot product is: " , fidelity, "\n")
 
     else:
         # Code for inidividual compiler pass testing
         print("Testing", pass_to_do)
         
-        pass_to_do = PassManager(opt_passes[pass_to_do])
-        pass_circ = pass_to_do.run(qc)
+        pass_circ = opt_pms[pass_to_do].run(qc)
 
-        sv0 = simulate_circuit(qc)
-        sv1 = simulate_circuit(pass_circ)
+        sv1 = simulate_circuit(pass_circ).data
+        fidelity = np.abs(np.vdot(sv0.ravel(), sv1.ravel()))
 
         # Compare the circuit statevector before and after the pass
-        if(np.isclose(1.0, abs(vdot(sv0, sv1)), rtol=0, atol=1e-8)):
+        if(np.isclose(1.0, fidelity, rtol=0, atol=1e-8)):
             print("Statevectors are the same\n")
         else:
             print("Statevectors are the different")
-            print("dot product is: ", abs(vdot(sv0, sv1)), "\n") 
+            print("dot product is: ", fidelity, "\n") 
 
 def plot_qiskit_dist(counts : Counter[Tuple[int, ...], int], circuit_number : str):
     """
@@ -170,21 +249,23 @@ def plot_qiskit_dist(counts : Counter[Tuple[int, ...], int], circuit_number : st
     """
     plots_path.mkdir(exist_ok=True)
     filename = plots_path / ("circuit"+circuit_number+".png")
-    plot_histogram(counts, figsize=[9,5], filename=filename)
+    # Close the figure once saved, circuits share a long lived worker process so open figures would accumulate
+    fig = plot_histogram(counts, figsize=[9,5])
+    fig.savefig(filename)
+    plt.close(fig)
 
 def run_on_simulator(qc : QuantumCircuit, circuit_number : str):
     """
 		Run circuit through optimisation levels 0, 1, 2, 3. 0 is the ground truth. Compare probability distribution of results after O1, O2, and O3 with O0.
 	"""
 
-    # Lazy importing to speed up other circuits
-    from qiskit_aer import AerSimulator
-    s = AerSimulator()
+    s = _get_aer()
 
-    qc1 = transpile(qc, s, optimization_level=0)
-    c1 = s.run(qc1, shots=1024).result().get_counts()
+    # Transpile at every level up front so all variants are simulated in a single job
+    transpiled_circuits = [transpile(qc, s, optimization_level=i) for i in range(4)]
+    result = s.run(transpiled_circuits, shots=1024).result()
 
-    c1 = preprocess_counts(c1)
+    c1 = preprocess_counts(result.get_counts(0))
 
     verbose, plot = read_circ_args()
 	
@@ -194,9 +275,7 @@ def run_on_simulator(qc : QuantumCircuit, circuit_number : str):
     ks_vals = []
 
     for i in range(1, 4):
-        qcT = transpile(qc, s, optimization_level=i)
-        c = s.run(qcT, shots=1024).result().get_counts()
-        c = preprocess_counts(c)
+        c = preprocess_counts(result.get_counts(i))
 
         if(plot):
             plot_qiskit_dist(c, circuit_number+"_o"+str(i))
@@ -211,19 +290,18 @@ def run_pass_on_simulator(qc : QuantumCircuit, circuit_number : str, pass_to_run
 		Apply a specific pass on a circuit and run it on a simulator to obtain a probability distribution
     """
      
-	from qiskit_aer import AerSimulator
-	s = AerSimulator()
+	s = _get_aer()
      
 	_, plot = read_circ_args()
     
-	p = PassManager(opt_passes[pass_to_run])
-	pass_circ = p.run(qc)
+	pass_circ = opt_pms[pass_to_run].run(qc)
     
-	qc_original = transpile(qc, s, optimization_level=0)
-	qc_pass = transpile(pass_circ, s, optimization_level=0)
+	# Only transpile circuits the simulator cannot already run, then simulate both together
+	circuits = [circ if _runs_natively(circ, s) else transpile(circ, s, optimization_level=0) for circ in (qc, pass_circ)]
+	result = s.run(circuits, shots=1024).result()
 
-	c1 = preprocess_counts(s.run(qc_original, shots=1024).result().get_counts())
-	c2 = preprocess_counts(s.run(qc_pass, shots=1024).result().get_counts())
+	c1 = preprocess_counts(result.get_counts(0))
+	c2 = preprocess_counts(result.get_counts(1))
 
 	if(plot):
 		plot_qiskit_dist(c1, circuit_number+"_original")
@@ -233,10 +311,7 @@ def run_pass_on_simulator(qc : QuantumCircuit, circuit_number : str, pass_to_run
 	print("KS value:", ks_test(c1,c2,1024), "\n")
 
 def run_routing_simulation(qc : QuantumCircuit, circuit_number : str):
-    # Lazy importing of Backend
-    from qiskit.providers.fake_provider import GenericBackendV2
-    
-    s_unrestricted = GenericBackendV2(num_qubits=qc.num_qubits, seed=1234, noise_info=False)
+    s_unrestricted = _get_generic_backend(qc.num_qubits)
 
     # Level 0 to have minimum optimisation while achieving routing pass
     new_circ_lv0 = transpile(qc, backend=s_unrestricted, optimization_level=0, target=s_unrestricted.target)
@@ -247,21 +322,29 @@ def run_routing_simulation(qc : QuantumCircuit, circuit_number : str):
         plot_qiskit_dist(counts_unrestricted, circuit_number)
 
     map = generate_custom_mapping(qc.num_qubits)
-    s_restricted = GenericBackendV2(num_qubits=qc.num_qubits, seed=1234, coupling_map=map, noise_info=False)
+    s_restricted = _get_generic_backend(qc.num_qubits, map)
     print("Testing custom routing map: ", map, "on simulator")
 
+    early_exit = read_early_exit()
+
     ks_vals = []
     for i in range(0, 4):
         qcT = transpile(qc, s_restricted, optimization_level=i)
         c = s_restricted.run(qcT, shots=1024).result().get_counts()
         c = preprocess_counts(c)
         
-        ks_vals.append(("o"+str(i), ks_test(counts_unrestricted, c, 1024)))
+        p_value = ks_test(counts_unrestricted, c, 1024)
+        ks_vals.append(("o"+str(i), p_value))
 
 
         if(plot): 
             plot_qiskit_dist(c, circuit_number)
 
+        # This level is already a bug candidate, so skip the more expensive higher levels
+        if(early_exit and p_value < EARLY_EXIT_P_VALUE):
+            print("Stopping early after level", i)
+            break
+
     # Simply prints the ksvals for manual validation
     print("KS values:", ks_vals, "\n")
     
\ No newline at end of file
@@ -3,9 +3,15 @@ import argparse
 import os 
 import sys
 import shutil
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+from worker import DONE_MARKER
 
 QC_DIR = "quantum_circuits"
 PLOTS_DIR = os.path.join(QC_DIR, "plots")
+LOG_PATH = os.path.join(QC_DIR, "_results.txt")
+WORKER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "worker.py")
 
 def progress_bar(current : int, total : int) -> None:
     # Calculate progress and lengths for the filled and empty parts of the bar
@@ -20,14 +26,49 @@ def progress_bar(current : int, total : int) -> None:
 
 def setup_dir() -> None:
     if(os.path.exists(QC_DIR)):
-        for file in os.listdir(QC_DIR):
-            path = os.path.join(QC_DIR, file)
-            if(os.path.isfile(path)):
-                os.remove(path)
+        # Clear out everything left over from a previous run, including plots
+        shutil.rmtree(QC_DIR, ignore_errors=True)
+        os.makedirs(QC_DIR, exist_ok=True)
     else:
         os.mkdir(QC_DIR)
         print("Created", QC_DIR, "directory")
 
+def start_worker(verbose : str, plot : str, early_exit : str) -> subprocess.Popen:
+    """
+        Start a worker process that runs the circuits it is sent
+    """
+    return subprocess.Popen(
+        ["python3", "-Wi", WORKER_PATH, verbose, plot, early_exit],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT
+    )
+
+def run_circuit(worker : subprocess.Popen, path : str) -> Tuple[bytes, Optional[bool]]:
+    """
+        Send a circuit to a worker and collect everything printed while running it. 
+        Also returns whether the circuit ran successfully, or None if the worker died while running it
+    """
+    marker = DONE_MARKER.encode()
+    output = []
+
+    try:
+        worker.stdin.write(path.encode() + b"\n")
+        worker.stdin.flush()
+    except OSError:
+        return b"", None
+
+    for line in worker.stdout:
+        i = line.find(marker)
+
+        if i != -1:
+            output.append(line[:i])
+            return b"".join(output), line[i + len(marker):].strip() == b"0"
+
+        output.append(line)
+
+    return b"".join(output), None
+
 def main() -> int:
     parser = argparse.ArgumentParser(description="Runs QuteFuzz generator and differential tester")
 
@@ -35,25 +76,20 @@ def main() -> int:
     parser.add_argument("--n", type=str, help="Number of programs to generate", default="1")
     parser.add_argument("-v", action="store_true",  help="Verbose adds extra information to the results log file")
     parser.add_argument("-p", action="store_true", help="Plot graphs")
+    parser.add_argument("-e", action="store_true", help="Stop testing a circuit at the first optimisation level that looks like a bug")
 
     args = parser.parse_args()
 
     setup_dir()
 
-    # vars passed to python circuits for verbose results and plotting
+    # vars passed to python circuits for verbose results, plotting and stopping early
     verbose = "-v" if (args.v) else ""
     plot = "-p" if (args.p) else ""
+    early_exit = "-e" if (args.e) else ""
 
-    # create plots directory if plotting is enabled
+    # create plots directory if plotting is enabled, setup_dir has already removed any old one
     if args.p:
-        # Clear the plots directory if it exists
-        if os.path.exists(PLOTS_DIR):
-            shutil.rmtree(PLOTS_DIR)
-        # Create the plots directory
         os.mkdir(PLOTS_DIR)
-    # Clear the plots directory if plotting is disabled
-    elif(os.path.exists(PLOTS_DIR) and not args.p):
-        shutil.rmtree(PLOTS_DIR)
 
     # compile the generate
     subprocess.run("make")
@@ -71,28 +107,47 @@ def main() -> int:
 
     # run circuits
     print("Running cirucits ....")
-    for i, file in enumerate(sorted(os.listdir(QC_DIR), key = lambda x: int(x.split('.')[0][7:]) if "py" in x else 0)):
-        path = os.path.join(QC_DIR, file)
-        
-        if (not os.path.isdir(path) and (file.split(".")[1] == "py")):
-            
-            log_path = os.path.join(QC_DIR, "_results.txt")
-
-            progress_bar(i+1, int(args.n))
-
-            with open(log_path, "a") as f:
-                
-                try:
-                    subprocess.run(
-                        ["python3", "-Wi", path, verbose, plot],
-                        stdout=f,
-                        stderr=subprocess.STDOUT,
-                        check=True
-                    )
-                except Exception as e:
-                    print(f"\nERROR '{e}' occurred while running circuits, check", log_path, "for details")
-
-    print("\nResults in ", log_path)
+    circuit_paths = [os.path.join(QC_DIR, file) for file in sorted(
+        (file for file in os.listdir(QC_DIR) if file.endswith(".py")),
+        key = lambda x: int(x.split('.')[0][7:])
+    )]
+
+    # Circuits are independent, so run them concurrently on a pool of long lived workers, which are capped to the number of 
+    # circuits so small runs stay cheap. Output of each circuit is collected and written in order to the results log, which is opened once
+    workers = max(1, min(os.cpu_count() or 1, len(circuit_paths)))
+    idle_workers = queue.Queue()
+
+    for _ in range(workers):
+        idle_workers.put(start_worker(verbose, plot, early_exit))
+
+    def run(path : str) -> bytes:
+        worker = idle_workers.get()
+        output, ok = run_circuit(worker, path)
+
+        if ok is None:
+            # Worker crashed part way through the circuit (e.g. a simulator segfault), replace it
+            output += f"\n{path} crashed with exit code {worker.wait()}\n".encode()
+            worker = start_worker(verbose, plot, early_exit)
+
+        idle_workers.put(worker)
+
+        if not ok:
+            print(f"\nERROR occurred while running {path}, check", LOG_PATH, "for details")
+
+        return output
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor, open(LOG_PATH, "ab", buffering=1 << 20) as log:
+            for i, output in enumerate(executor.map(run, circuit_paths)):
+                progress_bar(i+1, len(circuit_paths))
+                log.write(output)
+    finally:
+        while not idle_workers.empty():
+            worker = idle_workers.get()
+            worker.stdin.close()
+            worker.wait()
+
+    print("\nResults in ", LOG_PATH)
     return 0
 
 if __name__ == "__main__":
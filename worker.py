@@ -0,0 +1,39 @@
+import runpy
+import sys
+import traceback
+
+# Printed after each circuit has run, followed by 0 if it ran successfully and 1 otherwise
+DONE_MARKER = "\0circuit done"
+
+def main() -> None:
+    """
+        Long lived process used by run.py so qiskit, cirq and pytket are imported once rather than once per circuit.
+        Reads circuit paths from stdin, one per line, and runs each as if it was run as a script with the flags this worker was started with
+    """
+    flags = sys.argv[1:]
+
+    # Keep tracebacks in order with everything else the circuit prints
+    sys.stderr = sys.stdout
+
+    for line in sys.stdin:
+        path = line.strip()
+
+        if not path:
+            continue
+
+        sys.argv = [path] + flags
+        status = 0
+
+        try:
+            runpy.run_path(path, run_name="__main__")
+        except SystemExit as e:
+            status = 0 if e.code in (None, 0) else 1
+        except Exception:
+            traceback.print_exc()
+            status = 1
+
+        print(DONE_MARKER, status, flush=True)
+
+if __name__ == "__main__":
+
+    main()